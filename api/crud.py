@@ -1,6 +1,9 @@
-from .db import cf_kv_cache, d1_query
+import json
+from typing import Iterator
+from .db import D1TableMissing, cf_kv_cache, d1_query
 
 HIDDEN_CATEGORY_ID = 93
+EPISODE_COLUMNS = "e.id, e.title, e.desc, e.excerpt, e.thumb, e.cover, e.comments_count, e.likes_count, e.bookmarks_count, e.duration, e.is_free, e.published_at"
 
 
 @cf_kv_cache
@@ -41,7 +44,7 @@ def get_episodes_with_filters(
         sort_field = "published_at"
     direction = "ASC" if asc else "DESC"
 
-    sql = "SELECT DISTINCT e.id, e.title, e.desc, e.excerpt, e.thumb, e.cover, e.comments_count, e.likes_count, e.bookmarks_count, e.duration, e.is_free, e.published_at FROM episodes e"
+    sql = f"SELECT DISTINCT {EPISODE_COLUMNS} FROM episodes e"
     joins = ["JOIN episode_category ec_filter ON e.id = ec_filter.episode_id"]
     conditions = ["ec_filter.category_id != ?"]
     params: list = [HIDDEN_CATEGORY_ID]
@@ -75,7 +78,32 @@ def get_episodes_with_filters(
     sql += f" ORDER BY e.{sort_field} {direction} LIMIT ? OFFSET ?"
     params.extend([limit, offset])
 
-    rows = d1_query(sql, params)
+    return _attach_djs(d1_query(sql, params))
+
+
+@cf_kv_cache
+def get_related_episodes(episode_id: int) -> list[dict] | None:
+    """Related episodes in rank order, or None (not cached) if `episode_id` has no row."""
+    try:
+        related = d1_query("SELECT related FROM related_episodes WHERE episode_id = ?", [episode_id])
+    except D1TableMissing:  # related_episodes is created by the first sync that builds it
+        return None
+    if not related:
+        return None
+
+    ranked_ids = [rid for rid, _score in json.loads(related[0]["related"])]
+    if not ranked_ids:
+        return []
+    placeholders = ",".join(["?"] * len(ranked_ids))
+    rows = d1_query(
+        f"SELECT {EPISODE_COLUMNS} FROM episodes e WHERE e.id IN ({placeholders})",
+        ranked_ids)
+    order = {rid: i for i, rid in enumerate(ranked_ids)}
+    rows.sort(key=lambda r: order[r["id"]])
+    return _attach_djs(rows)
+
+
+def _attach_djs(rows: list[dict]) -> list[dict]:
     if not rows:
         return rows
 
@@ -93,3 +121,72 @@ def get_episodes_with_filters(
         row["is_free"] = bool(row["is_free"])
         row["djs"] = dj_map.get(row["id"], [])
     return rows
+
+
+def iter_episode_chunks(after_id: int = 0, changed_after: int = -1, chunk_size: int = 500) -> Iterator[list[dict]]:
+    """Yield visible episodes in id order with djs, category_ids and album_ids, one chunk at a time.
+
+    Only episodes whose updated_at is past `changed_after` are included.
+    Chunks are fetched by keyset (`id > last seen`), and their links through
+    the same id range and change filter, so every query binds a constant
+    number of parameters.
+    """
+    chunk_ids = "SELECT id FROM episodes WHERE id > ? AND id <= ? AND updated_at > ?"
+    while True:
+        rows = d1_query(
+            f"SELECT {EPISODE_COLUMNS}, e.updated_at FROM episodes e WHERE e.id > ? AND e.updated_at > ? AND EXISTS "
+            "(SELECT 1 FROM episode_category ec WHERE ec.episode_id = e.id AND ec.category_id != ?) "
+            "ORDER BY e.id LIMIT ?",
+            [after_id, changed_after, HIDDEN_CATEGORY_ID, chunk_size])
+        if not rows:
+            return
+
+        bounds = [after_id, rows[-1]["id"], changed_after]
+        djs, categories, albums = {}, {}, {}
+        for r in d1_query(
+                "SELECT eu.episode_id, u.id, u.nickname, u.thumb FROM episode_user eu JOIN users u ON eu.user_id = u.id "
+                f"WHERE eu.episode_id IN ({chunk_ids})", bounds):
+            djs.setdefault(r["episode_id"], []).append({"id": r["id"], "nickname": r["nickname"], "thumb": r["thumb"]})
+        for r in d1_query(
+                f"SELECT episode_id, category_id FROM episode_category WHERE episode_id IN ({chunk_ids}) AND category_id != ?",
+                [*bounds, HIDDEN_CATEGORY_ID]):
+            categories.setdefault(r["episode_id"], []).append(r["category_id"])
+        for r in d1_query(f"SELECT episode_id, album_id FROM episode_album WHERE episode_id IN ({chunk_ids})", bounds):
+            albums.setdefault(r["episode_id"], []).append(r["album_id"])
+
+        for row in rows:
+            row["is_free"] = bool(row["is_free"])
+            row["djs"] = djs.get(row["id"], [])
+            row["category_ids"] = categories.get(row["id"], [])
+            row["album_ids"] = albums.get(row["id"], [])
+        yield rows
+
+        if len(rows) < chunk_size:
+            return
+        after_id = rows[-1]["id"]
+
+
+_episode_columns: set[str] = set()
+
+
+def has_episode_column(name: str) -> bool:
+    """Whether the sync has added `name` to episodes yet (positive answers are remembered)."""
+    if name not in _episode_columns:
+        _episode_columns.update(r["name"] for r in d1_query("PRAGMA table_info(episodes)"))
+    return name in _episode_columns
+
+
+def get_episode_audio(episode_ids: list[int]) -> dict[int, str]:
+    if not episode_ids:
+        return {}
+    placeholders = ",".join(["?"] * len(episode_ids))
+    rows = d1_query(f"SELECT id, audio FROM episodes WHERE id IN ({placeholders}) AND audio != ''", episode_ids)
+    return {r["id"]: r["audio"] for r in rows}
+
+
+def get_sync_generation() -> int:
+    try:
+        rows = d1_query("SELECT value FROM sync_meta WHERE key = 'generation'")
+    except D1TableMissing:  # sync_meta is created by the first sync that changes data
+        return 0
+    return int(rows[0]["value"]) if rows else 0
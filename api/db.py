@@ -5,6 +5,8 @@ from functools import wraps
 from pathlib import Path
 from loguru import logger
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import httpx
 from dotenv import load_dotenv
 
@@ -36,6 +38,10 @@ def _get_client() -> httpx.Client:
 
 # --- D1 ---
 
+class D1TableMissing(RuntimeError):
+    """The query referenced a table the sync has not created yet."""
+
+
 def d1_query(sql: str, params: list | None = None) -> list[dict]:
     body: dict[str, Any] = {"sql": sql}
     if params:
@@ -46,55 +52,187 @@ def d1_query(sql: str, params: list | None = None) -> list[dict]:
     elapsed = time.perf_counter() - start
     if not data.get("success"):
         logger.error(f"D1 query failed ({elapsed:.3f}s): {data.get('errors')} | SQL: {sql[:200]}")
+        if "no such table" in str(data.get("errors")):
+            raise D1TableMissing(f"D1 query failed: {data.get('errors')}")
         raise RuntimeError(f"D1 query failed: {data.get('errors')}")
     logger.info(f"D1 query OK ({elapsed:.3f}s): {sql[:80]}")
     return data["result"][0].get("results", [])
 
 
 # --- Cloudflare KV (raw httpx, no SDK) ---
+#
+# Entries are stored as {"value": ..., "fresh_until": <unix ts>}. Past
+# fresh_until the value is still served while a background refresh runs;
+# KV only drops the key after KV_STALE_TTL. Misses are written before
+# returning: a serverless instance may be frozen once the response is
+# sent, and a lost refresh only means the next request retries it.
+# Concurrent misses on the same key in one process share a single call.
+
+KV_TTL = 3600  # 1 hour, soft expiry
+KV_STALE_TTL = 86400  # 1 day, hard expiry enforced by KV
+KV_BULK_API = KV_API.rsplit("/", 1)[0] + "/bulk"
+
+_kv_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="kv")
+_refreshing: set[str] = set()
+_refreshing_lock = threading.Lock()
+_loading: dict[str, "_Load"] = {}  # guarded by _refreshing_lock
+
 
-KV_TTL = 3600  # 1 hour
+class _Load:
+    """One in-flight miss; concurrent callers for the same key wait on it."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Exception | None = None
+
+
+def _kv_entry(value: Any) -> dict:
+    return {"value": value, "fresh_until": time.time() + KV_TTL}
 
 
 def _kv_get(key: str) -> Optional[Any]:
+    content = kv_get_bytes(key)
+    return None if content is None else json.loads(content)
+
+
+def _kv_put(key: str, value: Any) -> None:
+    _get_client().put(
+        f"{KV_API}/{key}",
+        headers=CF_HEADERS,
+        data=json.dumps(_kv_entry(value)),
+        params={"expiration_ttl": KV_STALE_TTL},
+    ).raise_for_status()
+
+
+def _kv_put_many(items: dict[str, Any]) -> None:
+    if not items:
+        return
+    if len(items) == 1:
+        _kv_put(*next(iter(items.items())))
+        return
+    body = [
+        {"key": key, "value": json.dumps(_kv_entry(value)), "expiration_ttl": KV_STALE_TTL}
+        for key, value in items.items()
+    ]
+    _get_client().put(
+        KV_BULK_API,
+        headers={**CF_HEADERS, "Content-Type": "application/json"},
+        json=body,
+    ).raise_for_status()
+
+
+def _refresh_later(cache_key: str, func: Callable, args: tuple, kwargs: dict) -> None:
+    with _refreshing_lock:
+        if cache_key in _refreshing:
+            return
+        _refreshing.add(cache_key)
+
+    def run():
+        try:
+            result = func(*args, **kwargs)
+            if result is not None:
+                _kv_put(cache_key, result)
+                logger.info(f"KV refreshed: {cache_key}")
+        except Exception as e:
+            logger.warning(f"KV refresh failed: {e}")
+        finally:
+            with _refreshing_lock:
+                _refreshing.discard(cache_key)
+    _kv_executor.submit(run)
+
+
+def kv_get_bytes(key: str) -> Optional[bytes]:
     resp = _get_client().get(f"{KV_API}/{key}", headers=CF_HEADERS)
     if resp.status_code == 404:
         return None
     resp.raise_for_status()
-    return json.loads(resp.content)
+    return resp.content
 
 
-def _kv_put(key: str, value: Any) -> None:
+def kv_put_bytes(key: str, data: bytes, ttl: int = KV_STALE_TTL) -> None:
     _get_client().put(
         f"{KV_API}/{key}",
-        headers=CF_HEADERS,
-        data=json.dumps(value),
-        params={"expiration_ttl": KV_TTL},
-    )
+        headers={**CF_HEADERS, "Content-Type": "application/octet-stream"},
+        content=data,
+        params={"expiration_ttl": ttl},
+    ).raise_for_status()
+
+
+def _cache_key(func: Callable, args: tuple, kwargs: dict) -> str:
+    key_parts = [str(arg) for arg in args]
+    key_parts.extend(f"{k}:{v}" for k, v in sorted(kwargs.items()))
+    return f"cache:{func.__name__}:{':'.join(key_parts)}"
+
+
+def _load_once(cache_key: str, func: Callable, args: tuple, kwargs: dict) -> Any:
+    """Run func and store the result, letting only one caller per key do so at a time."""
+    with _refreshing_lock:
+        load = _loading.get(cache_key)
+        leader = load is None
+        if leader:
+            load = _loading[cache_key] = _Load()
+
+    if not leader:
+        load.done.wait()
+        if load.error is not None:
+            raise load.error
+        return load.result
+
+    try:
+        load.result = func(*args, **kwargs)
+        if load.result is not None:
+            try:
+                _kv_put(cache_key, load.result)
+            except Exception as e:
+                logger.warning(f"KV put failed: {e}")
+        return load.result
+    except Exception as e:
+        load.error = e
+        raise
+    finally:
+        with _refreshing_lock:
+            _loading.pop(cache_key, None)
+        load.done.set()
 
 
 def cf_kv_cache(func: Callable):
     @wraps(func)
     def wrapper(*args, **kwargs):
-        key_parts = [str(arg) for arg in args]
-        key_parts.extend(f"{k}:{v}" for k, v in sorted(kwargs.items()))
-        cache_key = f"cache:{func.__name__}:{':'.join(key_parts)}"
+        cache_key = _cache_key(func, args, kwargs)
 
         start = time.perf_counter()
         try:
             cached = _kv_get(cache_key)
             if cached is not None:
-                logger.info(f"KV hit ({time.perf_counter() - start:.3f}s): {cache_key}")
-                return cached
+                # Entries written before soft expiry existed are bare values.
+                if isinstance(cached, dict) and "fresh_until" in cached:
+                    value, fresh_until = cached["value"], cached["fresh_until"]
+                else:
+                    value, fresh_until = cached, 0
+                if time.time() < fresh_until:
+                    logger.info(f"KV hit ({time.perf_counter() - start:.3f}s): {cache_key}")
+                else:
+                    logger.info(f"KV stale ({time.perf_counter() - start:.3f}s): {cache_key}")
+                    _refresh_later(cache_key, func, args, kwargs)
+                return value
         except Exception as e:
             logger.warning(f"KV get failed: {e}")
 
-        result = func(*args, **kwargs)
+        return _load_once(cache_key, func, args, kwargs)
 
-        if result is not None:
-            try:
-                _kv_put(cache_key, result)
-            except Exception as e:
-                logger.warning(f"KV put failed: {e}")
-        return result
+    wrapper.uncached = func
     return wrapper
+
+
+def warm_cache(*funcs: Callable) -> int:
+    """Recompute argument-less cf_kv_cache functions and store them in one bulk write."""
+    items = {}
+    for cached_func in funcs:
+        func = cached_func.uncached
+        result = func()
+        if result is not None:
+            items[_cache_key(func, (), {})] = result
+    _kv_put_many(items)
+    logger.info(f"KV warmed {len(items)} keys")
+    return len(items)
@@ -0,0 +1,164 @@
+"""Podcast RSS feeds per DJ, album and category.
+
+Feeds are rendered once per sync generation into gzip'd bytes and kept
+in memory and in KV, so a poll costs one (briefly cached) generation
+lookup at most.
+"""
+import gzip
+import io
+import mimetypes
+import re
+import threading
+import time
+from collections import OrderedDict
+from email.utils import formatdate
+from xml.sax.saxutils import XMLGenerator
+
+from loguru import logger
+
+from .crud import (get_episodes_with_filters, get_episode_audio, get_all_users, get_all_albums, get_all_categories,
+                   get_sync_generation, HIDDEN_CATEGORY_ID)
+from .db import kv_get_bytes, kv_put_bytes
+from .models import RESERVED_USER_IDS, RESERVED_ALBUM_IDS
+from .schemas import Episode
+
+FEED_KINDS = ("user", "album", "category")
+FEED_LIMIT = 50
+FEED_MEMORY_SLOTS = 64
+GENERATION_CHECK_INTERVAL = 60  # seconds
+FEED_FORMAT = 2  # bump when _render output changes, so stored feeds are not reused
+
+SITE_URL = "https://g.jrd.pub"
+EPISODE_URL = "https://www.gcores.com/radios/{}"
+IMAGE_URL = "https://image.gcores.com/{}"
+ITUNES_NS = "http://www.itunes.com/dtds/podcast-1.0.dtd"
+
+# Characters XML 1.0 does not allow, even escaped.
+_XML_ILLEGAL = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+_feeds: OrderedDict[tuple[str, int], tuple[int, bytes]] = OrderedDict()
+_feeds_lock = threading.Lock()
+_generation = (0.0, 0)  # (checked_at, generation)
+
+
+def current_generation() -> int:
+    """The sync generation, re-read at most once a minute.
+
+    If D1 cannot be reached the last known value is kept (and retried on
+    the next call); with nothing known yet the error propagates.
+    """
+    global _generation
+    checked_at, generation = _generation
+    if time.monotonic() - checked_at > GENERATION_CHECK_INTERVAL:
+        try:
+            generation = get_sync_generation()
+        except Exception as e:
+            if not checked_at:
+                raise
+            logger.warning(f"Sync generation check failed, keeping {generation}: {e}")
+            return generation
+        _generation = (time.monotonic(), generation)
+    return generation
+
+
+def _channel(kind: str, feed_id: int) -> dict | None:
+    if kind == "user" and feed_id in RESERVED_USER_IDS:
+        user = next((u for u in get_all_users() if u["id"] == feed_id), None)
+        if user:
+            return {"title": user["nickname"], "description": f"{user['nickname']} 参与的节目", "image": user["thumb"],
+                    "filters": {"user_ids": [feed_id]}}
+    elif kind == "album" and feed_id in RESERVED_ALBUM_IDS:
+        album = next((a for a in get_all_albums() if a["id"] == feed_id), None)
+        if album:
+            return {"title": album["title"], "description": album["description"], "image": album["cover"],
+                    "filters": {"album_id": feed_id}}
+    elif kind == "category" and feed_id != HIDDEN_CATEGORY_ID:
+        category = next((c for c in get_all_categories() if c["id"] == feed_id), None)
+        if category:
+            return {"title": category["name"], "description": category["desc"], "image": category["logo"],
+                    "filters": {"category_id": feed_id}}
+    return None
+
+
+def _element(xml: XMLGenerator, name: str, text: str | None = None, attrs: dict | None = None) -> None:
+    xml.startElement(name, attrs or {})
+    if text:
+        xml.characters(_XML_ILLEGAL.sub("", text))
+    xml.endElement(name)
+
+
+def _render(channel: dict, episodes: list[dict]) -> bytes:
+    """Items without an `audio` URL are left out, since podcast apps cannot play them."""
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode="wb", mtime=0) as out:
+        xml = XMLGenerator(out, encoding="utf-8", short_empty_elements=True)
+        xml.startDocument()
+        xml.startElement("rss", {"version": "2.0", "xmlns:itunes": ITUNES_NS})
+        xml.startElement("channel", {})
+        _element(xml, "title", f"{channel['title']} - Jcores")
+        _element(xml, "link", SITE_URL)
+        _element(xml, "description", channel["description"])
+        _element(xml, "language", "zh-cn")
+        if channel["image"]:
+            _element(xml, "itunes:image", attrs={"href": IMAGE_URL.format(channel["image"])})
+        for ep in episodes:
+            if not ep.get("audio"):
+                continue
+            xml.startElement("item", {})
+            _element(xml, "title", ep["title"])
+            _element(xml, "link", EPISODE_URL.format(ep["id"]))
+            _element(xml, "guid", EPISODE_URL.format(ep["id"]), {"isPermaLink": "true"})
+            _element(xml, "description", ep["desc"] or ep["excerpt"])
+            _element(xml, "pubDate", formatdate(ep["published_at"].timestamp(), usegmt=True))
+            _element(xml, "itunes:author", ", ".join(dj["nickname"] for dj in ep["djs"]))
+            _element(xml, "enclosure", attrs={
+                "url": ep["audio"],
+                "length": "0",  # Gcores does not report file sizes; 0 is the usual placeholder
+                "type": mimetypes.guess_type(ep["audio"])[0] or "audio/mpeg",
+            })
+            _element(xml, "itunes:duration", str(ep["duration"]))
+            if ep["thumb"]:
+                _element(xml, "itunes:image", attrs={"href": IMAGE_URL.format(ep["thumb"])})
+            xml.endElement("item")
+        xml.endElement("channel")
+        xml.endElement("rss")
+        xml.endDocument()
+    return buf.getvalue()
+
+
+def get_feed(kind: str, feed_id: int, generation: int) -> bytes | None:
+    """Gzip'd RSS for the feed at `generation`, or None if the feed does not exist."""
+    slot = (kind, feed_id)
+    with _feeds_lock:
+        cached = _feeds.get(slot)
+        if cached and cached[0] == generation:
+            _feeds.move_to_end(slot)
+            return cached[1]
+
+    kv_key = f"feed:v{FEED_FORMAT}:{kind}:{feed_id}:{generation}"
+    try:
+        body = kv_get_bytes(kv_key)
+    except Exception as e:
+        logger.warning(f"KV get failed: {e}")
+        body = None
+
+    if body is None:
+        channel = _channel(kind, feed_id)
+        if channel is None:
+            return None
+        rows = get_episodes_with_filters(**channel["filters"], limit=FEED_LIMIT)
+        audio = get_episode_audio([r["id"] for r in rows])
+        episodes = [{**Episode.model_validate(e).model_dump(), "audio": audio.get(e["id"])} for e in rows]
+        body = _render(channel, episodes)
+        try:
+            kv_put_bytes(kv_key, body)
+        except Exception as e:
+            logger.warning(f"KV put failed: {e}")
+        logger.info(f"Feed rendered ({len(body)} bytes gz): {kv_key}")
+
+    with _feeds_lock:
+        _feeds[slot] = (generation, body)
+        _feeds.move_to_end(slot)
+        while len(_feeds) > FEED_MEMORY_SLOTS:
+            _feeds.popitem(last=False)
+    return body
@@ -1,12 +1,16 @@
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from typing import Optional
 import os
+import gzip
 import httpx
+from email.utils import formatdate, parsedate_to_datetime
 from .schemas import Episode, User, Category, Album
-from .crud import get_episodes_with_filters, get_all_users, get_all_categories, get_all_albums
+from .crud import get_episodes_with_filters, get_related_episodes, has_episode_column, get_all_users, get_all_categories, get_all_albums
 from .models import RESERVED_ALBUM_IDS
+from .feeds import FEED_KINDS, current_generation, get_feed
+from .export import EXPORT_FORMATS, iter_ndjson, iter_gzip
 
 app = FastAPI(root_path="/api/py")
 
@@ -55,6 +59,50 @@ def get_episodes(
     return cached_json(data)
 
 
+@app.get("/episodes/{episode_id}/related")
+def get_related(episode_id: int):
+    db_episodes = get_related_episodes(episode_id)
+    if db_episodes is None:
+        raise HTTPException(status_code=404, detail="Episode not found")
+    data = [Episode.model_validate(e).model_dump(mode="json") for e in db_episodes]
+    return cached_json(data)
+
+
+@app.get("/export")
+def export_catalogue(request: Request, since: Optional[int] = None, after: int = 0, format: str = "ndjson"):
+    """Stream the catalogue as NDJSON.
+
+    `since` is a sync generation (the `generation` of a previous export's
+    end line) and limits episodes to those added or changed after it:
+    new episodes, updated like/comment/bookmark counts and new album links.
+    """
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of {', '.join(EXPORT_FORMATS)}")
+
+    # Fail before streaming: once the 200 is sent an error can only truncate the body.
+    try:
+        generation = current_generation()
+        ready = has_episode_column("updated_at")
+    except Exception:
+        raise HTTPException(status_code=503, detail="Export temporarily unavailable")
+    if not ready:
+        raise HTTPException(status_code=503, detail="Export is available after the next sync")
+
+    headers = {
+        "Cache-Control": CACHE_10M,
+        "ETag": f'"export-{generation}-{since}-{after}-{format}"',
+        "Content-Disposition": f'attachment; filename="jcores-export.{format}"',
+    }
+    if_none_match = request.headers.get("if-none-match", "")
+    if headers["ETag"] in [t.strip().removeprefix("W/") for t in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+
+    body = iter_ndjson(generation, since, after)
+    if format == "ndjson.gz":
+        return StreamingResponse(iter_gzip(body), media_type="application/gzip", headers=headers)
+    return StreamingResponse(body, media_type="application/x-ndjson", headers=headers)
+
+
 @app.get("/users")
 def get_users():
     db_users = get_all_users()
@@ -79,6 +127,74 @@ def get_albums():
     return cached_json(data)
 
 
+def accepts_gzip(accept_encoding: str) -> bool:
+    """Whether an Accept-Encoding header allows gzip, honouring q-values and `*`."""
+    q = {}
+    for part in accept_encoding.split(","):
+        coding, _, params = part.strip().partition(";")
+        if not coding:
+            continue
+        weight = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0
+        q[coding.strip().lower()] = weight
+    return q.get("gzip", q.get("x-gzip", q.get("*", 0.0))) > 0
+
+
+@app.get("/feeds/{kind}/{feed_id}.xml")
+def get_feed_xml(kind: str, feed_id: int, request: Request):
+    if kind not in FEED_KINDS:
+        raise HTTPException(status_code=404, detail="Feed not found")
+
+    try:
+        generation = current_generation()
+        ready = has_episode_column("audio")
+    except Exception:
+        raise HTTPException(status_code=503, detail="Feeds temporarily unavailable")
+    if not ready:
+        raise HTTPException(status_code=503, detail="Feeds are available after the next sync")
+
+    body = get_feed(kind, feed_id, generation)
+    if body is None:
+        raise HTTPException(status_code=404, detail="Feed not found")
+
+    use_gzip = accepts_gzip(request.headers.get("accept-encoding", ""))
+    # Strong validators must differ between content-codings.
+    etag = f'"{kind}-{feed_id}-{generation}"' if use_gzip else f'"{kind}-{feed_id}-{generation}-id"'
+    headers = {
+        "Cache-Control": CACHE_10M,
+        "ETag": etag,
+        "Vary": "Accept-Encoding",
+    }
+    if generation:
+        headers["Last-Modified"] = formatdate(generation, usegmt=True)
+
+    if_none_match = request.headers.get("if-none-match")
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_none_match is not None:
+        not_modified = headers["ETag"] in [t.strip().removeprefix("W/") for t in if_none_match.split(",")]
+    elif if_modified_since and generation:
+        try:
+            not_modified = parsedate_to_datetime(if_modified_since).timestamp() >= generation
+        except (TypeError, ValueError):
+            not_modified = False
+    else:
+        not_modified = False
+    if not_modified:
+        return Response(status_code=304, headers=headers)
+
+    if use_gzip:
+        headers["Content-Encoding"] = "gzip"
+    else:
+        body = gzip.decompress(body)
+    return Response(content=body, media_type="application/rss+xml; charset=utf-8", headers=headers)
+
+
 @app.get("/image-proxy/{path:path}")
 async def proxy_image(path: str):
     try:
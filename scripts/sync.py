@@ -9,17 +9,24 @@ Crawling etiquette:
   - Small page sizes (20 items)
   - Identifies itself via User-Agent
   - Early termination on known data (no redundant fetching)
-  - Total requests per run: ~13 (normal hourly), ~25 (catchup)
+  - Total requests per run: ~13 (normal hourly), ~25 (catchup),
+    plus up to 5 while old episodes' audio URLs are backfilled
 """
 import os
 import sys
+import json
 import time
+import heapq
+from datetime import datetime, timezone
 import httpx
 from dotenv import load_dotenv
 
 load_dotenv(os.path.join(os.path.dirname(__file__), '..', '.env.local'))
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
 
+from api.db import warm_cache
+from api.crud import HIDDEN_CATEGORY_ID, get_all_users, get_all_categories, get_all_albums
+
 CF_ACCOUNT_ID = os.environ["CLOUDFLARE_ACCOUNT_ID"].strip()
 CF_EMAIL = os.environ["CLOUDFLARE_EMAIL"].strip()
 CF_API_KEY = os.environ["CLOUDFLARE_API_KEY"].strip()
@@ -28,6 +35,7 @@ D1_DB_ID = os.environ["D1_DATABASE_ID"].strip()
 D1_API = f"https://api.cloudflare.com/client/v4/accounts/{CF_ACCOUNT_ID}/d1/database/{D1_DB_ID}/query"
 D1_HEADERS = {"X-Auth-Email": CF_EMAIL, "X-Auth-Key": CF_API_KEY, "Content-Type": "application/json"}
 GCORES_BASE = "https://www.gcores.com/gapi/v1"
+D1_MAX_PARAMS = 100  # bound parameters per statement
 REQUEST_DELAY = 2
 USER_AGENT = "JCores-Sync/1.0 (https://g.jrd.pub; hourly podcast index)"
 
@@ -52,6 +60,14 @@ def d1_query(sql, params=None):
     return r.get("results", []) if r else []
 
 
+def d1_query_strict(sql, params=None):
+    """Like d1_query, but raises instead of returning [] on failure."""
+    r = d1(sql, params)
+    if r is None:
+        raise RuntimeError(f"D1 query failed: {sql[:80]}")
+    return r.get("results", [])
+
+
 def gcores_get(path, params=None):
     global _request_count
     time.sleep(REQUEST_DELAY)
@@ -62,9 +78,50 @@ def gcores_get(path, params=None):
     return resp.json()
 
 
+# --- Step 0: Episode columns added after the original schema ---
+
+EPISODE_COLUMNS = {
+    "updated_at": "INTEGER NOT NULL DEFAULT 0",  # generation of the episode's last change
+    "audio": "TEXT",  # NULL = not fetched yet, '' = Gcores has no audio
+}
+
+
+def ensure_episode_columns():
+    columns = {r["name"] for r in d1_query("PRAGMA table_info(episodes)")}
+    for name, decl in EPISODE_COLUMNS.items():
+        if name not in columns:
+            print(f"=== Adding episodes.{name} ===")
+            d1(f"ALTER TABLE episodes ADD COLUMN {name} {decl}")
+    d1("CREATE INDEX IF NOT EXISTS idx_episodes_updated_at ON episodes (updated_at, id)")
+
+
+def mark_updated(episode_ids, generation):
+    ids = sorted(set(episode_ids))
+    step = D1_MAX_PARAMS - 1
+    for i in range(0, len(ids), step):
+        batch = ids[i:i+step]
+        d1(f"UPDATE episodes SET updated_at=? WHERE id IN ({','.join(['?'] * len(batch))})", [generation, *batch])
+
+
+def audio_urls(data):
+    """Map radio id -> audio URL ('' if none) from a response that included `media`."""
+    media = {}
+    for inc in data.get("included", []):
+        if inc["type"] == "medias":
+            audio = inc["attributes"].get("audio")
+            if isinstance(audio, list):
+                audio = audio[0] if audio else None
+            media[inc["id"]] = audio or ""
+    urls = {}
+    for ep in data.get("data", []):
+        rel = ep.get("relationships", {}).get("media", {}).get("data")
+        urls[int(ep["id"])] = media.get(rel["id"], "") if rel else ""
+    return urls
+
+
 # --- Step 1: Sync new episodes + authors + categories + albums ---
 
-def sync_new_episodes():
+def sync_new_episodes(generation):
     """Fetch latest episodes until we hit ones we already have.
 
     Each episode response includes DJs (-> users), category, and albums
@@ -92,13 +149,14 @@ def sync_new_episodes():
             "page[limit]": page_size,
             "page[offset]": offset,
             "sort": "-published-at",
-            "include": "user,djs,category,albums",
-            "fields[radios]": "title,desc,excerpt,thumb,cover,comments-count,likes-count,bookmarks-count,published-at,duration,is-free,djs,category,albums",
+            "include": "user,djs,category,albums,media",
+            "fields[radios]": "title,desc,excerpt,thumb,cover,comments-count,likes-count,bookmarks-count,published-at,duration,is-free,djs,category,albums,media",
         })
 
         episodes = data.get("data", [])
         if not episodes:
             break
+        audio = audio_urls(data)
 
         overlap_count = 0
         for ep in episodes:
@@ -116,7 +174,7 @@ def sync_new_episodes():
                 a.get("thumb") or "", a.get("cover") or "",
                 a.get("comments-count", 0), a.get("likes-count", 0), a.get("bookmarks-count", 0),
                 a.get("duration", 0), 1 if a.get("is-free", True) else 0,
-                a.get("published-at", ""),
+                a.get("published-at", ""), audio.get(eid, ""),
             ))
 
             for dj in ep.get("relationships", {}).get("djs", {}).get("data", []):
@@ -158,7 +216,7 @@ def sync_new_episodes():
     print(f"  Found {len(new_episodes)} new episodes, {len(new_users)} users, {len(new_categories)} categories, {len(new_albums)} albums")
 
     for ep in new_episodes:
-        d1("INSERT OR IGNORE INTO episodes (id,title,desc,excerpt,thumb,cover,comments_count,likes_count,bookmarks_count,duration,is_free,published_at) VALUES (?,?,?,?,?,?,?,?,?,?,?,?)", list(ep))
+        d1("INSERT OR IGNORE INTO episodes (id,title,desc,excerpt,thumb,cover,comments_count,likes_count,bookmarks_count,duration,is_free,published_at,audio,updated_at) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)", [*ep, generation])
 
     for u in new_users.values():
         d1("INSERT OR REPLACE INTO users (id,nickname,thumb,followers_count,followees_count) VALUES (?,?,?,?,?)", list(u))
@@ -178,13 +236,17 @@ def sync_new_episodes():
     for aid, eid in episode_albums:
         d1("INSERT OR IGNORE INTO episode_album (album_id,episode_id) VALUES (?,?)", [aid, eid])
 
-    return len(new_episodes)
+    return [ep[0] for ep in new_episodes]
 
 
 # --- Step 2: Update stats for recent episodes ---
 
-def update_episode_stats():
-    """Batch-update likes/bookmarks/comments for the 100 most recent episodes."""
+def update_episode_stats(generation):
+    """Batch-update likes/bookmarks/comments for the 100 most recent episodes.
+
+    Only rows whose counts actually changed get their updated_at bumped
+    (and are counted).
+    """
     print("=== Updating episode stats ===")
 
     recent = d1_query("SELECT id FROM episodes ORDER BY published_at DESC LIMIT 100")
@@ -205,9 +267,12 @@ def update_episode_stats():
         for ep in data.get("data", []):
             eid = int(ep["id"])
             a = ep["attributes"]
-            d1("UPDATE episodes SET comments_count=?, likes_count=?, bookmarks_count=? WHERE id=?",
-               [a.get("comments-count", 0), a.get("likes-count", 0), a.get("bookmarks-count", 0), eid])
-            updated += 1
+            stats = [a.get("comments-count", 0), a.get("likes-count", 0), a.get("bookmarks-count", 0)]
+            r = d1("UPDATE episodes SET comments_count=?, likes_count=?, bookmarks_count=?, updated_at=? "
+                   "WHERE id=? AND (comments_count!=? OR likes_count!=? OR bookmarks_count!=?)",
+                   [*stats, generation, eid, *stats])
+            if r and r.get("meta", {}).get("changes"):
+                updated += 1
 
     print(f"  Updated {updated} episodes")
     return updated
@@ -257,8 +322,11 @@ def sync_albums():
 
 # --- Step 4: Sync episode-album links for incomplete albums ---
 
-def sync_album_episodes():
-    """Fetch episode lists for albums where our link count is below radios_count."""
+def sync_album_episodes(generation):
+    """Fetch episode lists for albums where our link count is below radios_count.
+
+    Returns the ids of episodes that gained an album link.
+    """
     print("=== Syncing album episode links ===")
 
     albums = d1_query("""
@@ -270,12 +338,14 @@ def sync_album_episodes():
     """)
     if not albums:
         print("  All albums complete")
-        return 0
+        return []
 
     print(f"  {len(albums)} albums need updating")
     total_new = 0
+    linked = []
     for album in albums:
         aid = album["id"]
+        known = {r["episode_id"] for r in d1_query("SELECT episode_id FROM episode_album WHERE album_id = ?", [aid])}
         offset = 0
         album_new = 0
         while True:
@@ -286,14 +356,184 @@ def sync_album_episodes():
             if not eps:
                 break
             for ep in eps:
-                d1("INSERT OR IGNORE INTO episode_album (album_id,episode_id) VALUES (?,?)", [aid, int(ep["id"])])
+                eid = int(ep["id"])
+                d1("INSERT OR IGNORE INTO episode_album (album_id,episode_id) VALUES (?,?)", [aid, eid])
+                if eid not in known:
+                    linked.append(eid)
                 album_new += 1
             offset += 50
         total_new += album_new
         print(f"  Album {aid} ({album['title'][:20]}): {album_new} links", flush=True)
 
     print(f"  Total: {total_new} links synced")
-    return total_new
+    mark_updated(linked, generation)
+    return linked
+
+
+# --- Step 4b: Backfill audio URLs ---
+
+AUDIO_BACKFILL_BATCHES = 5  # x 20 episodes per run, newest first
+
+
+def sync_episode_audio(generation):
+    """Fetch the audio URL for episodes synced before the audio column existed."""
+    print("=== Backfilling episode audio ===")
+
+    missing = [r["id"] for r in d1_query(
+        "SELECT id FROM episodes WHERE audio IS NULL ORDER BY published_at DESC LIMIT ?", [AUDIO_BACKFILL_BATCHES * 20])]
+    if not missing:
+        print("  All episodes have audio info")
+        return []
+
+    filled = []
+    for i in range(0, len(missing), 20):
+        batch = missing[i:i+20]
+        data = gcores_get("radios", {
+            "page[limit]": 20,
+            "filter[id]": ",".join(str(eid) for eid in batch),
+            "include": "media",
+            "fields[radios]": "media",
+        })
+        urls = audio_urls(data)
+        for eid in batch:  # episodes Gcores no longer returns get '' so they are not retried
+            url = urls.get(eid, "")
+            d1("UPDATE episodes SET audio=?, updated_at=? WHERE id=?", [url, generation, eid])
+            if url:
+                filled.append(eid)
+
+    print(f"  Found audio for {len(filled)} of {len(missing)} episodes")
+    return filled
+
+
+# --- Step 5: Precompute related episodes ---
+
+RELATED_K = 10
+WEIGHT_DJ = 2.0
+WEIGHT_ALBUM = 3.0
+WEIGHT_CATEGORY = 0.5
+RECENCY_DAYS = 365  # score halves at this publish-date gap
+
+
+def _parse_date(value):
+    """Parse to an aware UTC datetime; naive values are taken as UTC."""
+    try:
+        parsed = datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+    if parsed.tzinfo is None:
+        return parsed.replace(tzinfo=timezone.utc)
+    return parsed.astimezone(timezone.utc)
+
+
+def _related_for(eid, ep_djs, ep_albums, ep_category, dj_eps, album_eps, published):
+    """Top-K episodes sharing a DJ or album with `eid`, scored by overlap and publish-date gap."""
+    shared = {}
+    for uid in ep_djs.get(eid, ()):
+        for other in dj_eps[uid]:
+            shared.setdefault(other, [0, 0])[0] += 1
+    for aid in ep_albums.get(eid, ()):
+        for other in album_eps[aid]:
+            shared.setdefault(other, [0, 0])[1] += 1
+    shared.pop(eid, None)
+
+    scored = []
+    base = published.get(eid)
+    for other, (djs, albums) in shared.items():
+        score = WEIGHT_DJ * djs + WEIGHT_ALBUM * albums
+        if ep_category.get(other) == ep_category.get(eid):
+            score += WEIGHT_CATEGORY
+        other_date = published.get(other)
+        if base and other_date:
+            score /= 1 + abs((base - other_date).days) / RECENCY_DAYS
+        scored.append((score, other))
+    return [[other, round(score, 4)] for score, other in heapq.nlargest(RELATED_K, scored)]
+
+
+def sync_related_episodes(changed_ids):
+    """Refresh the related_episodes table; failures are reported, not raised.
+
+    Recomputes episodes in `changed_ids`, the episodes sharing a DJ or
+    album with them (nothing else can see their scores change), and any
+    visible episode still missing a row — which covers the first run and
+    batches lost to earlier write failures.
+    """
+    print("=== Syncing related episodes ===")
+    try:
+        return _sync_related_episodes(changed_ids)
+    except Exception as e:
+        print(f"  Related episodes failed: {e}")
+        return 0
+
+
+def _sync_related_episodes(changed_ids):
+    if d1("CREATE TABLE IF NOT EXISTS related_episodes (episode_id INTEGER PRIMARY KEY, related TEXT NOT NULL)") is None:
+        raise RuntimeError("could not create related_episodes")
+    existing = {r["episode_id"] for r in d1_query_strict("SELECT episode_id FROM related_episodes")}
+
+    ep_category = {r["episode_id"]: r["category_id"] for r in d1_query_strict(
+        "SELECT episode_id, category_id FROM episode_category WHERE category_id != ?", [HIDDEN_CATEGORY_ID])}
+    published = {r["id"]: _parse_date(r["published_at"]) for r in d1_query_strict("SELECT id, published_at FROM episodes")
+                 if r["id"] in ep_category}
+
+    ep_djs, dj_eps, ep_albums, album_eps = {}, {}, {}, {}
+    for r in d1_query_strict("SELECT episode_id, user_id FROM episode_user"):
+        if r["episode_id"] in published:
+            ep_djs.setdefault(r["episode_id"], []).append(r["user_id"])
+            dj_eps.setdefault(r["user_id"], []).append(r["episode_id"])
+    for r in d1_query_strict("SELECT album_id, episode_id FROM episode_album"):
+        if r["episode_id"] in published:
+            ep_albums.setdefault(r["episode_id"], []).append(r["album_id"])
+            album_eps.setdefault(r["album_id"], []).append(r["episode_id"])
+
+    targets = {eid for eid in changed_ids if eid in published}
+    for eid in list(targets):
+        for uid in ep_djs.get(eid, ()):
+            targets.update(dj_eps[uid])
+        for aid in ep_albums.get(eid, ()):
+            targets.update(album_eps[aid])
+    targets |= published.keys() - existing
+    if not targets:
+        print("  Nothing to recompute")
+        return 0
+    print(f"  Recomputing {len(targets)} of {len(published)} episodes")
+
+    rows = [(eid, json.dumps(_related_for(eid, ep_djs, ep_albums, ep_category, dj_eps, album_eps, published)))
+            for eid in sorted(targets)]
+    written = 0
+    step = D1_MAX_PARAMS // 2
+    for i in range(0, len(rows), step):
+        batch = rows[i:i+step]
+        if d1("INSERT OR REPLACE INTO related_episodes (episode_id,related) VALUES " + ",".join(["(?,?)"] * len(batch)),
+              [v for row in batch for v in row]) is not None:
+            written += len(batch)
+    if written < len(rows):
+        print(f"  {len(rows) - written} rows failed to write; they will be retried next run")
+
+    return written
+
+
+# --- Step 6: Bump the sync generation ---
+
+def bump_generation(generation):
+    """Record when the catalogue last changed; the API rebuilds feeds and exports when this moves."""
+    d1("CREATE TABLE IF NOT EXISTS sync_meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+    d1("INSERT OR REPLACE INTO sync_meta (key,value) VALUES ('generation',?)", [str(generation)])
+    print(f"=== Sync generation: {generation} ===")
+    return generation
+
+
+# --- Step 7: Warm the API's KV cache ---
+
+def warm_api_cache():
+    """Rewrite the cached users/categories/albums lists in one KV bulk write."""
+    print("=== Warming API cache ===")
+    try:
+        warmed = warm_cache(get_all_users, get_all_categories, get_all_albums)
+    except Exception as e:
+        print(f"  Cache warm failed: {e}")
+        return 0
+    print(f"  Warmed {warmed} keys")
+    return warmed
 
 
 # --- Main ---
@@ -304,10 +544,17 @@ def main():
     start = time.time()
     print(f"Sync started at {time.strftime('%Y-%m-%d %H:%M:%S')}\n")
 
-    new_eps = sync_new_episodes()
-    updated = update_episode_stats()
+    generation = int(start)
+    ensure_episode_columns()
+    new_ep_ids = sync_new_episodes(generation)
+    updated = update_episode_stats(generation)
     new_albums = sync_albums()
-    sync_album_episodes()
+    linked_ep_ids = sync_album_episodes(generation)
+    audio_ep_ids = sync_episode_audio(generation)
+    related = sync_related_episodes(set(new_ep_ids) | set(linked_ep_ids))
+    if new_ep_ids or updated or linked_ep_ids or audio_ep_ids or new_albums:
+        bump_generation(generation)
+    warmed = warm_api_cache()
 
     elapsed = time.time() - start
     totals = {}
@@ -316,9 +563,11 @@ def main():
         totals[t] = r[0]["c"]
 
     summary = {
-        "new_episodes": new_eps,
+        "new_episodes": len(new_ep_ids),
         "stats_updated": updated,
         "new_albums": new_albums,
+        "related_recomputed": related,
+        "cache_warmed": warmed,
         "elapsed_seconds": round(elapsed),
         "gcores_requests": _request_count,
         "totals": totals,